@@ -1,13 +1,28 @@
+import asyncio
+import copy
+import itertools
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import struct
+import threading
 import time
+import types
+import uuid
+import numpy as np
 import torch
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+import aiofiles
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse
 from typing import Optional
 import torchaudio
 import soundfile as sf
-from pydub import AudioSegment, silence
+import soxr
+from pydub import AudioSegment
 import re
 from importlib.resources import files
 from cached_path import cached_path
@@ -21,6 +36,9 @@ from pydantic import BaseModel
 sys.path.append("/workspace/F5-TTS")
 
 from f5_tts.api import F5TTS
+from f5_tts.infer.utils_infer import convert_char_to_pinyin, preprocess_ref_audio_text
+from f5_tts.model.modules import get_pos_embed_indices
+from f5_tts.model.utils import list_str_to_idx
 
 logging.basicConfig(level=logging.INFO)
 
@@ -37,6 +55,12 @@ app.add_middleware(
 
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
+# No gradients are ever needed: model calls run under torch.inference_mode (see the decorated functions below),
+# TF32 is allowed for the remaining fp32 matmuls and cuDNN picks the fastest kernels for the bucketed shapes
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
 # Initialize F5-TTS model with English settings
 model = F5TTS(
     device=device,
@@ -48,6 +72,215 @@ model = F5TTS(
     ckpt_file=str(cached_path("hf://SWivid/F5-TTS/F5TTS_Base/model_1200000.safetensors"))  # Use the base model
 )
 
+# Run the DiT and the Vocos backbone in half precision on CUDA: bf16 on Ampere and newer, fp16 otherwise
+if device.startswith("cuda"):
+    model_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    model.ema_model = model.ema_model.to(model_dtype)
+    # The ISTFT head stays in fp32, complex half tensors are not supported by torch.istft
+    model.vocoder.backbone = model.vocoder.backbone.to(model_dtype)
+else:
+    model_dtype = torch.float32
+
+# Weight-only int8 quantization of the DiT blocks (needs torchao); the modulation, norms and output projection
+# stay in model_dtype. Activations keep running in model_dtype.
+# Opt-in with F5_TTS_QUANTIZE_DIT=1 until its quality has been checked against the unquantized model.
+quantize_dit = device.startswith("cuda") and os.environ.get("F5_TTS_QUANTIZE_DIT", "0") == "1"
+
+def quantize_int8_weights(transformer):
+    """Return an int8 weight-only copy of the DiT; the copy keeps a failure part way through off the model."""
+    from torchao.quantization import quantize_, int8_weight_only
+
+    transformer = copy.deepcopy(transformer)
+    quantize_(
+        transformer,
+        int8_weight_only(),
+        filter_fn=lambda module, fqn: (
+            isinstance(module, torch.nn.Linear)
+            and fqn.startswith("transformer_blocks.")
+            and ".attn_norm." not in fqn
+        ),
+    )
+    return transformer
+
+if quantize_dit:
+    # A torchao build for another torch version fails with more than ImportError (missing symbols, removed APIs)
+    try:
+        model.ema_model.transformer = quantize_int8_weights(model.ema_model.transformer)
+    except Exception as e:
+        logging.warning(f"torchao int8 weight quantization failed ({e}), running the DiT in {model_dtype}.")
+
+model_target_rms = 0.1
+max_batch_chunks = 8  # text chunks (from any request) sampled together in one batched diffusion call
+cross_fade_duration = 0.15  # seconds of overlap between consecutive chunks
+# Log-mel value of silence (Vocos mels are clamped at 1e-5 before the log), used to pad vocoder inputs
+mel_silence = math.log(1e-5)
+batch_max_wait = 0.01  # seconds the batch worker waits for more jobs before sampling
+
+# Vocos runs on its own CUDA stream so it overlaps with the DiT of the next batch
+vocoder_stream = torch.cuda.Stream() if device.startswith("cuda") else None
+upload_chunk_size = 1 << 20  # bytes read per step when persisting uploads
+
+# Compile the DiT forward into CUDA graphs; inputs are padded to power-of-two buckets, starting at these
+# sizes, so graphs are reused
+compile_dit = device.startswith("cuda")
+mel_frame_bucket = 256
+text_token_bucket = 64
+max_mel_frames = 4096  # CFM.sample clamps durations to this
+# Every bucket up to ~512 tokens (reference + 25s chunk) and max_mel_frames is compiled at startup,
+# so the first request of any length does not pay for compilation
+prewarm_text_buckets = (64, 128, 256, 512)
+prewarm_mel_buckets = (256, 512, 1024, 2048, 4096)
+
+def round_up(n, multiple):
+    """Round n up to the nearest multiple."""
+    return -(-n // multiple) * multiple
+
+def bucket_size(n, smallest):
+    """Round n up to the nearest power-of-two bucket, no smaller than smallest."""
+    return max(smallest, 1 << (n - 1).bit_length())
+
+# The batch dimension is bucketed too (1, 2, 4, 8 chunks), as the later chunks of a request arrive together
+prewarm_batch_sizes = tuple(sorted({bucket_size(batch, 1) for batch in range(1, max_batch_chunks + 1)}))
+
+def bucketed_forward(forward):
+    """Wrap a DiT forward so its inputs are padded (and masked) to bucketed static shapes."""
+    def wrapper(x, cond, text, time, drop_audio_cond, drop_text, mask=None):
+        batch, seq_len = x.shape[0], x.shape[1]
+        pad_len = bucket_size(seq_len, mel_frame_bucket) - seq_len
+        pad_text_len = bucket_size(text.shape[1], text_token_bucket) - text.shape[1]
+
+        if mask is None:
+            mask = torch.ones((batch, seq_len), dtype=torch.bool, device=x.device)
+        batch_size = bucket_size(batch, 1)
+        if batch_size != batch:
+            # Fill the extra rows with copies of the last one: fully masked rows would turn into NaNs
+            rows = torch.arange(batch_size, device=x.device).clamp(max=batch - 1)
+            x, cond, text, mask = x[rows], cond[rows], text[rows], mask[rows]
+            if time.ndim > 0:
+                time = time[rows]
+        x = F.pad(x, (0, 0, 0, pad_len), value=0.0)
+        cond = F.pad(cond, (0, 0, 0, pad_len), value=0.0)
+        mask = F.pad(mask, (0, pad_len), value=False)
+        text = F.pad(text, (0, pad_text_len), value=-1)
+
+        output = forward(
+            x=x, cond=cond, text=text, time=time, drop_audio_cond=drop_audio_cond, drop_text=drop_text, mask=mask
+        )
+        # CUDA graph outputs are overwritten by the next replay, so copy the unpadded part out
+        return output[:batch, :seq_len].clone()
+    return wrapper
+
+# SmoothCache-style layer caching: True marks the NFE steps that reuse the previous step's attention and
+# feed-forward outputs instead of recomputing them. Sway sampling packs the early steps closely together,
+# so alternate steps there are reused (8 of 32 steps, roughly the alpha=0.15 budget).
+SMOOTH_CACHE_SCHEDULE = tuple(3 <= step < 18 and step % 2 == 1 for step in range(32))
+
+class SmoothCache:
+    """Per-layer cache of DiT attention and feed-forward outputs, reused on scheduled denoising steps."""
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.active = False
+        self.steps = len(schedule)
+        self.branch = None
+        self.calls = {}
+        self.outputs = {}
+
+    @contextmanager
+    def enabled(self, steps):
+        """Activate the cache for one sampling call of the given number of steps."""
+        self.active, self.steps = True, steps
+        try:
+            yield
+        finally:
+            self.active = False
+            self.calls.clear()
+            self.outputs.clear()
+
+    def begin_step(self, branch):
+        """Advance the step counter of a CFG branch (conditional or unconditional pass)."""
+        self.branch = branch
+        self.calls[branch] = self.calls.get(branch, -1) + 1
+
+    def wrap(self, name, forward):
+        """Wrap a layer forward so its output is cached, and reused on scheduled steps."""
+        def cached_forward(*args, **kwargs):
+            if not self.active:
+                return forward(*args, **kwargs)
+            key = (self.branch, name)
+            step = self.calls[self.branch]
+            if key in self.outputs and self.schedule[step * len(self.schedule) // self.steps]:
+                return self.outputs[key]
+            output = forward(*args, **kwargs)
+            self.outputs[key] = output
+            return output
+        return cached_forward
+
+def text_embed_forward(self, text, seq_len, drop_text=False):
+    """TextEmbedding.forward, with the sinusoidal position indices built on the text's device.
+
+    Upstream builds them on the CPU, and reduce-overhead skips CUDA graphs for graphs spanning two devices.
+    """
+    text = text + 1  # use 0 as filler token
+    text = text[:, :seq_len]  # curtail if character tokens are more than the mel spec tokens
+    batch, text_len = text.shape[0], text.shape[1]
+    text = F.pad(text, (0, seq_len - text_len), value=0)
+
+    if drop_text:  # cfg for text
+        text = torch.zeros_like(text)
+
+    text = self.text_embed(text)
+
+    if self.extra_modeling:
+        batch_start = torch.zeros((batch,), dtype=torch.long, device=text.device)
+        pos_idx = get_pos_embed_indices(batch_start, seq_len, max_pos=self.precompute_max_pos)
+        text = text + self.freqs_cis[pos_idx]
+        text = self.text_blocks(text)
+
+    return text
+
+transformer = model.ema_model.transformer
+transformer.text_embed.forward = types.MethodType(text_embed_forward, transformer.text_embed)
+smooth_cache = SmoothCache(SMOOTH_CACHE_SCHEDULE)
+for i, block in enumerate(transformer.transformer_blocks):
+    block.attn.forward = smooth_cache.wrap(("attn", i), block.attn.forward)
+    block.ff.forward = smooth_cache.wrap(("ff", i), block.ff.forward)
+
+dit_forward_eager = transformer.forward
+if compile_dit:
+    # dynamic=False compiles one graph per mel bucket x text bucket x CFG branch (drop_text is a Python bool)
+    # x batch bucket; past Dynamo's cache_size_limit (8) the forward would silently fall back to eager.
+    # Two extra text buckets leave room for texts longer than the prewarmed ones.
+    dit_graph_count = len(prewarm_mel_buckets) * (len(prewarm_text_buckets) + 2) * 2 * len(prewarm_batch_sizes)
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, dit_graph_count)
+    torch._dynamo.config.accumulated_cache_size_limit = max(
+        torch._dynamo.config.accumulated_cache_size_limit, dit_graph_count
+    )
+    # Log every recompile, so shapes that were not prewarmed show up, and perf hints, which report any
+    # graph whose CUDA graph capture is skipped
+    torch._logging.set_logs(recompiles=True, perf_hints=True)
+    # fullgraph is left off, so a graph break in the upstream modules degrades instead of failing
+    # Only the compiled forward is bucketed: padding only pays off when it lets a CUDA graph be replayed
+    dit_forward_compiled = bucketed_forward(
+        torch.compile(dit_forward_eager, mode="reduce-overhead", dynamic=False)
+    )
+else:
+    dit_forward_compiled = dit_forward_eager
+
+def dit_forward(x, cond, text, time, drop_audio_cond, drop_text, mask=None):
+    """Run the DiT forward, eagerly on the true shapes while the SmoothCache is active, as its state cannot live
+    in a CUDA graph."""
+    if smooth_cache.active:
+        smooth_cache.begin_step(drop_text)
+        return dit_forward_eager(
+            x=x, cond=cond, text=text, time=time, drop_audio_cond=drop_audio_cond, drop_text=drop_text, mask=mask
+        )
+    return dit_forward_compiled(
+        x=x, cond=cond, text=text, time=time, drop_audio_cond=drop_audio_cond, drop_text=drop_text, mask=mask
+    )
+
+transformer.forward = dit_forward
+
 output_dir = 'outputs'
 os.makedirs(output_dir, exist_ok=True)
 
@@ -63,21 +296,99 @@ if not os.path.exists(f"{resources_dir}/default_en.wav"):
 
 os.makedirs("resources", exist_ok=True)
 
+def build_voice_index(directory):
+    """Map each voice label (file name without extension) in directory to its audio file, preferring WAV."""
+    index = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            label, extension = os.path.splitext(entry.name)
+            if label not in index or extension.lower() == '.wav':
+                index[label] = os.path.abspath(entry.path)
+    return index
+
+# Voice label -> reference audio file, kept up to date by /upload_audio/
+VOICE_INDEX: dict[str, str] = build_voice_index(resources_dir)
+voice_index_lock = asyncio.Lock()
+
+# Pinned host buffer for asynchronous reference audio transfers (references are clipped to ~15s)
+MAX_REF_SAMPLES = 30 * model.target_sample_rate
+PINNED_REF = torch.empty(MAX_REF_SAMPLES, dtype=torch.float32).pin_memory() if device.startswith("cuda") else None
+pinned_ref_lock = threading.Lock()
+pinned_ref_copied: Optional[torch.cuda.Event] = None
+
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+_CLAUSE_RE = re.compile(r"(?<=[;:,.!?])\s+|(?<=[；：，。！？])")
+
+# Reference audio cache: (reference_file, given ref_text) -> {"mtime", "ref_text", "ref_tokens", "ref_audio",
+# "ref_mel", "rms"}. Entries are invalidated when the file on disk changes.
+REF_CACHE: dict[tuple[str, str], dict] = {}
+# One lock per cache key, so concurrent misses for the same reference preprocess it only once
+ref_cache_locks: dict[tuple[str, str], threading.Lock] = {}
+ref_cache_locks_lock = threading.Lock()
+
+# Text chunk jobs for the single GPU worker, created on startup
+speech_queue: Optional[asyncio.Queue] = None
+speech_worker_task: Optional[asyncio.Task] = None
+# All DiT work (prewarm and batches) runs on this one thread: inductor's CUDA graph trees are thread-local,
+# so graphs captured on one thread would be re-recorded, with their own memory pool, on any other
+gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+
+def load_audio(input_path):
+    """Read an audio file as float32 samples, using pydub only for formats libsndfile cannot open."""
+    try:
+        return sf.read(input_path, dtype='float32', always_2d=False)
+    except RuntimeError:
+        if hasattr(input_path, 'seek'):
+            input_path.seek(0)
+        audio = AudioSegment.from_file(input_path)
+        data = np.array(audio.get_array_of_samples(), dtype=np.float32) / (1 << (8 * audio.sample_width - 1))
+        if audio.channels > 1:
+            data = data.reshape(-1, audio.channels)
+        return data, audio.frame_rate
+
 def convert_to_wav(input_path, output_path):
-    """Convert any audio format to WAV using pydub."""
-    audio = AudioSegment.from_file(input_path)
-    audio = audio.set_channels(1)  # Convert to mono
-    audio = audio.set_frame_rate(24000)  # Set to F5-TTS expected sample rate
-    audio.export(output_path, format='wav')
+    """Convert any audio format (a path or a file-like object) to a mono 24kHz WAV using soundfile and soxr."""
+    data, sr = load_audio(input_path)
+    if data.ndim > 1:
+        data = data.mean(axis=1)  # Convert to mono
+    if sr != 24000:
+        data = soxr.resample(data, sr, 24000, quality='HQ')  # Set to F5-TTS expected sample rate
+    sf.write(output_path, data, 24000, subtype='PCM_16')
 
 def split_text_into_sentences(text):
     """Split text into sentences using regex."""
     # Split on common sentence endings
-    sentences = re.split(r'(?<=[.!?])\s+', text)
+    sentences = _SENT_RE.split(text)
     # Remove empty sentences and extra whitespace
     sentences = [s.strip() for s in sentences if s.strip()]
     return sentences
 
+def chunk_text_clauses(text, max_chars=135):
+    """Pack the clauses of text into chunks of at most max_chars UTF-8 bytes, as f5_tts chunk_text does.
+
+    Clauses are re-joined with a single space (none after a multibyte ending), and a running byte count is
+    kept instead of re-encoding the growing chunk for every clause.
+    """
+    chunks = []
+    pieces = []
+    chunk_bytes = 0
+    for clause in _CLAUSE_RE.split(text):
+        clause_bytes = len(clause.encode("utf-8"))
+        if pieces and chunk_bytes + clause_bytes > max_chars:
+            chunks.append("".join(pieces).strip())
+            pieces, chunk_bytes = [], 0
+        if clause and len(clause[-1].encode("utf-8")) == 1:
+            clause += " "
+            clause_bytes += 1
+        pieces.append(clause)
+        chunk_bytes += clause_bytes
+
+    if pieces:
+        chunks.append("".join(pieces).strip())
+    return [chunk for chunk in chunks if chunk]
+
 def detect_leading_silence(audio, silence_threshold=-42, chunk_size=10):
     """Detect silence at the beginning of the audio."""
     trim_ms = 0
@@ -92,70 +403,451 @@ def remove_silence_edges(audio, silence_threshold=-42):
     duration = len(audio)
     return audio[start_trim:duration - end_trim]
 
+def fade_curves(n, device):
+    """Raised-cosine fade-out / fade-in ramps of n samples; they sum to one at every sample."""
+    t = torch.linspace(0, torch.pi / 2, n, device=device)
+    return torch.cos(t) ** 2, torch.sin(t) ** 2
+
+def cross_fade(waves, sr, cross_fade_duration=cross_fade_duration):
+    """Concatenate 1-D waveform tensors with a cos/sin cross-fade between consecutive pieces.
+
+    The result is assembled in a single pass into a preallocated tensor on the waveforms' device.
+    """
+    cross_fade_samples = int(cross_fade_duration * sr)
+    overlaps = []
+    for prev_wave, next_wave in zip(waves, waves[1:]):
+        # A piece can't give more samples to its next overlap than what is left after its previous one
+        prev_free = prev_wave.shape[-1] - (overlaps[-1] if overlaps else 0)
+        overlaps.append(max(min(cross_fade_samples, prev_free, next_wave.shape[-1]), 0))
+
+    final_wave = waves[0].new_empty(sum(wave.shape[-1] for wave in waves) - sum(overlaps))
+    curves = {}
+    pos = 0
+    for i, wave in enumerate(waves):
+        head = overlaps[i - 1] if i > 0 else 0  # already mixed in with the previous piece
+        tail = overlaps[i] if i < len(overlaps) else 0
+        body = wave[head:wave.shape[-1] - tail]
+        final_wave[pos:pos + body.shape[-1]] = body
+        pos += body.shape[-1]
+        if tail:
+            if tail not in curves:
+                curves[tail] = fade_curves(tail, wave.device)
+            fade_out, fade_in = curves[tail]
+            final_wave[pos:pos + tail] = wave[-tail:] * fade_out + waves[i + 1][:tail] * fade_in
+            pos += tail
+    return final_wave
+
+def vocode(mel):
+    """Decode a batch of mel spectrograms (b d n) to waveforms (b nw) with Vocos."""
+    x = model.vocoder.backbone(mel.to(model_dtype))
+    # The ISTFT head must not be autocast back to half precision
+    with torch.autocast(device_type="cuda", enabled=False):
+        return model.vocoder.head(x.float())
+
+async def find_voice_file(voice):
+    """Return the WAV file for a voice label, converting (once) voices only available in other formats."""
+    reference_file = VOICE_INDEX.get(voice)
+    if reference_file is None or reference_file.lower().endswith('.wav'):
+        return reference_file
+
+    async with voice_index_lock:
+        # A concurrent request may have converted it while this one waited for the lock
+        reference_file = VOICE_INDEX.get(voice)
+        if reference_file is None or reference_file.lower().endswith('.wav'):
+            return reference_file
+
+        wav_path = os.path.abspath(f'{output_dir}/{voice}.wav')
+        # Convert under a temporary name, so the WAV only ever appears complete
+        tmp_path = f'{output_dir}/{voice}.{uuid.uuid4().hex}.tmp.wav'
+        try:
+            await asyncio.to_thread(convert_to_wav, reference_file, tmp_path)
+            os.replace(tmp_path, wav_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        VOICE_INDEX[voice] = wav_path
+    return wav_path
+
+def tokenize(text):
+    """Tokenize text into vocab indices, the same way CFM.sample does for a string."""
+    return list_str_to_idx(convert_char_to_pinyin([text]), model.ema_model.vocab_char_map)[0]
+
+def upload_reference_audio(data):
+    """Copy reference samples to the device (as 1 x nw), through the pinned staging buffer when they fit in it."""
+    global pinned_ref_copied
+    samples = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+    if PINNED_REF is None or samples.shape[0] > PINNED_REF.shape[0]:
+        return samples.unsqueeze(0).to(device)
+
+    with pinned_ref_lock:
+        # The previous transfer may still be reading from the buffer
+        if pinned_ref_copied is not None:
+            pinned_ref_copied.synchronize()
+        staging = PINNED_REF[:samples.shape[0]]
+        staging.copy_(samples)
+        audio = staging.to(device, non_blocking=True).unsqueeze(0)
+        pinned_ref_copied = torch.cuda.Event()
+        pinned_ref_copied.record()
+    return audio
+
+@torch.inference_mode()
+def get_reference(reference_file, ref_text=""):
+    """Return the cached reference entry for a file, preprocessing it on first use or after it changed."""
+    mtime = os.path.getmtime(reference_file)
+    # A transcript cached for ref_text="" must not stand in for a caller-supplied text, and vice versa
+    cache_key = (reference_file, ref_text)
+    entry = REF_CACHE.get(cache_key)
+    if entry is not None and entry["mtime"] == mtime:
+        return entry
+
+    with ref_cache_locks_lock:
+        key_lock = ref_cache_locks.setdefault(cache_key, threading.Lock())
+    with key_lock:
+        # Another request may have preprocessed it while this one waited
+        entry = REF_CACHE.get(cache_key)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry
+        entry = preprocess_reference(reference_file, ref_text, mtime)
+        REF_CACHE[cache_key] = entry
+    return entry
+
+def preprocess_reference(reference_file, ref_text, mtime):
+    """Clip, transcribe (when ref_text is empty), normalize and mel-encode a reference file into a cache entry."""
+    logging.info(f'Preprocessing reference audio {reference_file}')
+    # Clips the reference to <15s and transcribes it when no ref_text is given
+    clipped_file, ref_text = preprocess_ref_audio_text(reference_file, ref_text, show_info=logging.info, device=device)
+    logging.info(f'Reference text: {ref_text}')
+
+    data, sr = load_audio(clipped_file)
+    os.remove(clipped_file)
+    if data.ndim > 1:
+        data = data.mean(axis=1)
+    rms = float(np.sqrt(np.mean(np.square(data))))
+    if rms < model_target_rms:
+        data = data * model_target_rms / rms
+    if sr != model.target_sample_rate:
+        data = soxr.resample(data, sr, model.target_sample_rate, quality='HQ')
+    audio = upload_reference_audio(data)
+
+    ref_mel = model.ema_model.mel_spec(audio).permute(0, 2, 1)
+
+    # The reference text is prepended to every chunk, tokenize it once
+    if len(ref_text[-1].encode("utf-8")) == 1:
+        ref_text = ref_text + " "
+
+    return {
+        "mtime": mtime,
+        "ref_text": ref_text,
+        "ref_tokens": tokenize(ref_text),
+        "ref_audio": audio,
+        "ref_mel": ref_mel,
+        "rms": rms,
+    }
+
+def plan_speech_jobs(
+        ref, gen_text, speed=1.0, nfe_step=32, cfg_strength=2.0, sway_sampling_coef=-1.0, use_smooth_cache=False
+):
+    """Split gen_text into chunks and describe each one as a job for the batch worker.
+
+    Jobs only share a sampling call with jobs of the same "sampling" settings.
+    With use_smooth_cache, scheduled denoising steps reuse cached DiT layer outputs.
+    """
+    ref_text = ref["ref_text"]
+    ref_audio_len = ref["ref_mel"].shape[1]
+    ref_seconds = ref["ref_audio"].shape[-1] / model.target_sample_rate
+
+    # Same chunk size heuristic as F5TTS.infer: keep reference + chunk under ~25s
+    max_chars = int(len(ref_text.encode("utf-8")) / ref_seconds * (25 - ref_seconds))
+    gen_text_batches = chunk_text_clauses(gen_text, max_chars=max_chars)
+
+    ref_text_len = len(ref_text.encode("utf-8"))
+
+    return [
+        {
+            "ref": ref,
+            "tokens": torch.cat([ref["ref_tokens"], tokenize(chunk)]),
+            "duration": ref_audio_len + int(ref_audio_len / ref_text_len * len(chunk.encode("utf-8")) / speed),
+            "sampling": (nfe_step, cfg_strength, sway_sampling_coef, use_smooth_cache),
+        }
+        for chunk in gen_text_batches
+    ]
+
+@torch.inference_mode()
+def sample_speech_batch(jobs, nfe_step, cfg_strength, sway_sampling_coef, use_smooth_cache):
+    """Run one batched diffusion pass over jobs, which may use different references, and launch their vocoding.
+
+    Returns the waveforms on the device and, on CUDA, the event marking the end of their vocoder pass and the
+    timing events around the DiT pass.
+    """
+    ref_lens = [job["ref"]["ref_mel"].shape[1] for job in jobs]
+    durations = [job["duration"] for job in jobs]
+
+    # Bypass F5TTS.infer so the cached reference mels are used as they are, padded to a common length
+    dit_timing = None
+    if vocoder_stream is not None:
+        dit_timing = (torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True))
+        dit_timing[0].record()
+    with torch.autocast(device_type="cuda", dtype=model_dtype, enabled=device.startswith("cuda")):
+        cond = pad_sequence([job["ref"]["ref_mel"][0] for job in jobs], batch_first=True)
+        with smooth_cache.enabled(nfe_step) if use_smooth_cache else nullcontext():
+            generated, _ = model.ema_model.sample(
+                cond=cond,
+                text=pad_sequence([job["tokens"] for job in jobs], padding_value=-1, batch_first=True).to(cond.device),
+                duration=torch.tensor(durations, device=cond.device, dtype=torch.long),
+                lens=torch.tensor(ref_lens, device=cond.device, dtype=torch.long),
+                steps=nfe_step,
+                cfg_strength=cfg_strength,
+                sway_sampling_coef=sway_sampling_coef,
+            )
+
+        # Cut each job's generated frames out of the batch and vocode them together
+        gen_mels = [generated[i, ref_len:duration] for i, (ref_len, duration) in enumerate(zip(ref_lens, durations))]
+        # Pad with silence: Vocos sees a few hundred ms around each frame, padding louder than that would
+        # leak into the end of the shorter chunks
+        gen_mel = pad_sequence(gen_mels, padding_value=mel_silence, batch_first=True).permute(0, 2, 1)
+        # Bucket the vocoder input length too, so cudnn.benchmark results are reused across batches
+        gen_mel = F.pad(
+            gen_mel, (0, round_up(gen_mel.shape[-1], mel_frame_bucket) - gen_mel.shape[-1]), value=mel_silence
+        )
+
+        # Decode on the vocoder stream, so the next batch's DiT can start on the default stream meanwhile
+        vocoded = None
+        if vocoder_stream is not None:
+            dit_done = dit_timing[1]
+            dit_done.record()
+            vocoder_stream.wait_event(dit_done)
+            gen_mel.record_stream(vocoder_stream)
+        with torch.cuda.stream(vocoder_stream) if vocoder_stream is not None else nullcontext():
+            generated_wave = vocode(gen_mel)
+            waves = []
+            for wave, mel, job in zip(generated_wave, gen_mels, jobs):
+                wave = wave[:mel.shape[0] * model.hop_length]
+                if job["ref"]["rms"] < model_target_rms:
+                    wave = wave * job["ref"]["rms"] / model_target_rms
+                waves.append(wave.to(torch.float32))
+            if vocoder_stream is not None:
+                vocoded = torch.cuda.Event()
+                vocoded.record(vocoder_stream)
+    return waves, vocoded, dit_timing
+
+async def resolve_speech_batch(items, waves, vocoded, dit_timing):
+    """Resolve the futures of a sampled batch with its device waveforms once its vocoder pass is done."""
+    try:
+        if vocoded is not None:
+            await asyncio.to_thread(vocoded.synchronize)
+        if dit_timing is not None:
+            # Per-batch DiT time, to compare the SmoothCache path (cache=smooth) with the compiled default
+            mode = "smooth cache" if items[0][0]["sampling"][3] else "default"
+            frames = max(job["duration"] for job, _ in items)
+            dit_ms = dit_timing[0].elapsed_time(dit_timing[1])
+            logging.info(f'DiT sampled {len(items)} chunks of up to {frames} frames ({mode}) in {dit_ms:.0f}ms')
+    except Exception as e:
+        logging.error(f"Error in speech batch: {str(e)}")
+        for _, future in items:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), wave in zip(items, waves):
+        if not future.done():
+            future.set_result(wave)
+
+def submit_speech_job(job):
+    """Queue a job for the batch worker and return the future resolved with its waveform."""
+    future = asyncio.get_running_loop().create_future()
+    speech_queue.put_nowait((job, future))
+    return future
+
+async def speech_batch_worker():
+    """Single consumer owning the GPU: drains queued jobs into padded batches and resolves their futures."""
+    loop = asyncio.get_running_loop()
+    pending_batches = set()
+    while True:
+        batch = [await speech_queue.get()]
+        deadline = loop.time() + batch_max_wait
+        while len(batch) < max_batch_chunks:
+            try:
+                batch.append(await asyncio.wait_for(speech_queue.get(), max(deadline - loop.time(), 0)))
+            except asyncio.TimeoutError:
+                break
+
+        groups = {}
+        for job, future in batch:
+            if not future.cancelled():  # the client went away
+                groups.setdefault(job["sampling"], []).append((job, future))
+
+        for sampling, items in groups.items():
+            try:
+                waves, vocoded, dit_timing = await loop.run_in_executor(
+                    gpu_executor, sample_speech_batch, [job for job, _ in items], *sampling
+                )
+            except Exception as e:
+                logging.error(f"Error in speech batch: {str(e)}")
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            # Collect the waveforms in the background while the next batch goes through the DiT
+            task = asyncio.create_task(resolve_speech_batch(items, waves, vocoded, dit_timing))
+            pending_batches.add(task)
+            task.add_done_callback(pending_batches.discard)
+
+def wav_stream_header(sr, channels=1, sample_width=2):
+    """Build a PCM WAV header with unknown (maximum) sizes, for streaming audio of unknown length."""
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 0xFFFFFFFF, b'WAVE',
+        b'fmt ', 16, 1, channels, sr, sr * channels * sample_width, channels * sample_width, sample_width * 8,
+        b'data', 0xFFFFFFFF,
+    )
+
+def to_pcm16(wave):
+    """Convert a float waveform tensor in [-1, 1] to little-endian 16-bit PCM bytes, with one copy to the CPU."""
+    return (wave.clamp(-1.0, 1.0) * 32767).to(torch.int16).cpu().numpy().astype('<i2', copy=False).tobytes()
+
+@torch.inference_mode()
+def mix_chunk(tail, wave):
+    """Cross-fade a chunk onto the held-back tail of the previous one, on the device.
+
+    Returns the PCM16 bytes ready to send and the new tail to hold back; a wave of None flushes the tail.
+    Runs on the vocoder stream so it does not queue behind the DiT work of the next batch.
+    """
+    sr = model.target_sample_rate
+    with torch.cuda.stream(vocoder_stream) if vocoder_stream is not None else nullcontext():
+        if wave is None:
+            return to_pcm16(tail), None
+        if tail is not None:
+            wave = cross_fade([tail, wave], sr, cross_fade_duration)
+        split = max(wave.shape[-1] - int(cross_fade_duration * sr), 0)
+        return to_pcm16(wave[:split]), wave[split:]
+
+async def stream_speech(jobs):
+    """Stream a WAV file chunk by chunk as the batch worker finishes each job of plan_speech_jobs.
+
+    The jobs are planned by the endpoint, so invalid input fails before the response starts.
+    The cross-fade tail of each chunk is held back until the next chunk arrives.
+    """
+    start_time = time.time()
+
+    yield wav_stream_header(model.target_sample_rate)
+
+    # Queue the first chunk on its own so its audio is not held up by the rest of the text
+    futures = [submit_speech_job(jobs[0])] if jobs else []
+    tail = None
+    try:
+        for i in range(len(jobs)):
+            wave = await futures[i]
+            if i == 0:
+                logging.info(f'First audio chunk ready after {time.time() - start_time:.2f}s')
+                futures += [submit_speech_job(job) for job in jobs[1:]]
+            pcm, tail = await asyncio.to_thread(mix_chunk, tail, wave)
+            yield pcm
+    finally:
+        for future in futures:
+            future.cancel()
+
+    if tail is not None:
+        pcm, _ = await asyncio.to_thread(mix_chunk, tail, None)
+        yield pcm
+    logging.info(f'Speech streamed in {time.time() - start_time:.2f}s')
+
+@torch.inference_mode()
+def prewarm_buckets(steps=4):
+    """Compile and capture the DiT graphs (both CFG branches) and autotune Vocos for every startup bucket."""
+    for batch, mel_len, text_len in itertools.product(prewarm_batch_sizes, prewarm_mel_buckets, prewarm_text_buckets):
+        if text_len > mel_len:  # the text never outgrows the mel frames it is spread over
+            continue
+        start_time = time.time()
+        # One real token padded to the bucket, so the text does not stretch the duration past mel_len
+        text = torch.full((batch, text_len), -1, dtype=torch.long, device=device)
+        text[:, 0] = 0
+        with torch.autocast(device_type="cuda", dtype=model_dtype):
+            generated, _ = model.ema_model.sample(
+                cond=torch.zeros((batch, mel_len // 4, model.ema_model.num_channels), device=device),
+                text=text,
+                duration=mel_len,
+                steps=steps,
+                cfg_strength=2.0,
+                sway_sampling_coef=-1.0,
+            )
+            vocode(generated.permute(0, 2, 1))
+        torch.cuda.synchronize()
+        logging.info(
+            f'Prewarmed bucket {batch} x {mel_len} mel frames x {text_len} tokens in {time.time() - start_time:.1f}s'
+        )
+
 class UploadAudioRequest(BaseModel):
     audio_file_label: str
 
 @app.on_event("startup")
 async def startup_event():
+    global speech_queue, speech_worker_task
+    speech_queue = asyncio.Queue()
+    speech_worker_task = asyncio.create_task(speech_batch_worker())
+
+    if compile_dit:
+        await asyncio.get_running_loop().run_in_executor(gpu_executor, prewarm_buckets)
+
     test_text = "This is a test sentence generated by the F5-TTS API."
     voice = "default_en"
-    await synthesize_speech(test_text, voice)
+    response = await synthesize_speech(test_text, voice, cache=None)
+    async for _ in response.body_iterator:
+        pass
 
 @app.get("/base_tts/")
-async def base_tts(text: str, speed: Optional[float] = 1.0):
+async def base_tts(
+        text: str,
+        speed: Optional[float] = 1.0,
+        cache: Optional[str] = Query(None, description="Set to 'smooth' to reuse DiT layer outputs across steps"),
+):
     """
     Perform text-to-speech conversion using only the base speaker.
     """
     try:
         # Use the default English voice
-        return await synthesize_speech(text=text, voice="default_en", speed=speed)
+        return await synthesize_speech(text=text, voice="default_en", speed=speed, cache=cache)
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in base_tts: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/change_voice/")
-async def change_voice(reference_speaker: str = Form(...), file: UploadFile = File(...)):
+async def change_voice(
+        background_tasks: BackgroundTasks, reference_speaker: str = Form(...), file: UploadFile = File(...)
+):
     """
     Change the voice of an existing audio file.
     """
+    # Save the input audio temporarily, under a name of its own so concurrent requests don't collide
+    input_path = f'{output_dir}/input_{uuid.uuid4().hex}.wav'
     try:
         logging.info(f'changing voice to {reference_speaker}...')
 
         contents = await file.read()
-        
-        # Save the input audio temporarily
-        input_path = f'{output_dir}/input_audio.wav'
-        with open(input_path, 'wb') as f:
-            f.write(contents)
+
+        async with aiofiles.open(input_path, 'wb') as f:
+            await f.write(contents)
 
         # Find the reference audio file
-        matching_files = [file for file in os.listdir("resources") if file.startswith(str(reference_speaker))]
-        if not matching_files:
+        reference_file = await find_voice_file(str(reference_speaker))
+        if reference_file is None:
             raise HTTPException(status_code=400, detail="No matching reference speaker found.")
-        
-        reference_file = f'resources/{matching_files[0]}'
-        
-        # Convert reference file to WAV if it's not already
-        if not reference_file.lower().endswith('.wav'):
-            ref_wav_path = f'{output_dir}/ref_converted.wav'
-            convert_to_wav(reference_file, ref_wav_path)
-            reference_file = ref_wav_path
-        
-        # For voice conversion, we'll use the same text for both reference and generation
-        # This helps maintain the timing and prosody
-        text = model.transcribe(input_path)
-        save_path = f'{output_dir}/output_converted.wav'
-
-        wav, sr, _ = model.infer(
-            ref_file=reference_file,
-            ref_text=text,
-            gen_text=text,
-            file_wave=save_path
-        )
 
-        result = StreamingResponse(open(save_path, 'rb'), media_type="audio/wav")
-        return result
+        ref = await asyncio.to_thread(get_reference, reference_file)
+
+        # Regenerate the transcript of the input audio in the reference voice
+        text = await asyncio.to_thread(torch.inference_mode()(model.transcribe), input_path)
+
+        jobs = await asyncio.to_thread(plan_speech_jobs, ref, text)
+
+        # The input file is only needed for the transcription, remove it once the response is sent
+        background_tasks.add_task(os.remove, input_path)
+        return StreamingResponse(stream_speech(jobs), media_type="audio/wav")
     except Exception as e:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/upload_audio/")
@@ -164,32 +856,58 @@ async def upload_audio(audio_file_label: str = Form(...), file: UploadFile = Fil
     Upload an audio file for later use as the reference audio.
     """
     try:
-        contents = await file.read()
-
         allowed_extensions = {'wav', 'mp3', 'flac', 'ogg'}
         max_file_size = 5 * 1024 * 1024  # 5MB
 
         if not file.filename.split('.')[-1] in allowed_extensions:
             return {"error": "Invalid file type. Allowed types are: wav, mp3, flac, ogg"}
 
-        if len(contents) > max_file_size:
-            return {"error": "File size is over limit. Max size is 5MB."}
-
-        temp_file = io.BytesIO(contents)
-        file_format = magic.from_buffer(temp_file.read(), mime=True)
+        # The content type only needs the first bytes of the file
+        first_chunk = await file.read(upload_chunk_size)
+        file_format = magic.from_buffer(first_chunk[:4096], mime=True)
 
         if 'audio' not in file_format:
             return {"error": "Invalid file content."}
 
         file_extension = file.filename.split('.')[-1]
         stored_file_name = f"{audio_file_label}.{file_extension}"
-
-        with open(f"resources/{stored_file_name}", "wb") as f:
-            f.write(contents)
-
-        # Also create a WAV version for F5-TTS
+        stored_path = f"resources/{stored_file_name}"
         wav_path = f"resources/{audio_file_label}.wav"
-        convert_to_wav(f"resources/{stored_file_name}", wav_path)
+
+        # Write the upload and its WAV version under temporary names, and only move them over the label's
+        # files once both are complete, so a rejected or failed re-upload leaves the existing voice intact
+        tmp_id = uuid.uuid4().hex
+        tmp_upload_path = f'{output_dir}/{audio_file_label}.{tmp_id}.tmp.{file_extension}'
+        tmp_wav_path = f'{output_dir}/{audio_file_label}.{tmp_id}.tmp.wav'
+        try:
+            # Stream the upload to disk, keeping the chunks for decoding without re-reading the file
+            chunks = []
+            size = 0
+            async with aiofiles.open(tmp_upload_path, "wb") as f:
+                chunk = first_chunk
+                while chunk:
+                    size += len(chunk)
+                    if size > max_file_size:
+                        break
+                    chunks.append(chunk)
+                    await f.write(chunk)
+                    chunk = await file.read(upload_chunk_size)
+
+            if size > max_file_size:
+                return {"error": "File size is over limit. Max size is 5MB."}
+
+            # Also create a WAV version for F5-TTS, decoded straight from the uploaded bytes
+            await asyncio.to_thread(convert_to_wav, io.BytesIO(b"".join(chunks)), tmp_wav_path)
+
+            async with voice_index_lock:
+                if stored_path != wav_path:
+                    os.replace(tmp_upload_path, stored_path)
+                os.replace(tmp_wav_path, wav_path)
+                VOICE_INDEX[audio_file_label] = os.path.abspath(wav_path)
+        finally:
+            for tmp_path in (tmp_upload_path, tmp_wav_path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
 
         return {"message": f"File {file.filename} uploaded successfully with label {audio_file_label}."}
     except Exception as e:
@@ -200,123 +918,38 @@ async def synthesize_speech(
         text: str,
         voice: str,
         speed: Optional[float] = 1.0,
+        cache: Optional[str] = Query(None, description="Set to 'smooth' to reuse DiT layer outputs across steps"),
 ):
     """
     Synthesize speech from text using a specified voice and style.
     """
-    start_time = time.time()
+    if cache not in (None, "smooth"):
+        raise HTTPException(status_code=400, detail="Invalid cache mode. Allowed modes are: smooth")
+
     try:
         logging.info(f'Generating speech for {voice}')
 
-        # First try to find a WAV version
-        matching_files = [f for f in os.listdir("resources") if f.startswith(voice) and f.lower().endswith('.wav')]
-        
-        # If no WAV found, try other formats and convert
-        if not matching_files:
-            matching_files = [f for f in os.listdir("resources") if f.startswith(voice)]
-            if not matching_files:
-                raise HTTPException(status_code=400, detail="No matching voice found.")
-            
-            # Convert to WAV
-            input_file = f'resources/{matching_files[0]}'
-            wav_path = f'{output_dir}/ref_converted.wav'
-            convert_to_wav(input_file, wav_path)
-            reference_file = wav_path
-        else:
-            reference_file = f'resources/{matching_files[0]}'
+        reference_file = await find_voice_file(voice)
+        if reference_file is None:
+            raise HTTPException(status_code=400, detail="No matching voice found.")
 
         # Use default text for default voice, transcribe for others
-        if voice == "default_en":
-            ref_text = default_ref_text
-        else:
-            # Process reference audio with silence detection for natural clipping
-            temp_short_ref = f'{output_dir}/temp_short_ref.wav'
-            aseg = AudioSegment.from_file(reference_file)
-
-            # 1. try to find long silence for clipping
-            non_silent_segs = silence.split_on_silence(
-                aseg, min_silence_len=1000, silence_thresh=-50, keep_silence=1000, seek_step=10
-            )
-            non_silent_wave = AudioSegment.silent(duration=0)
-            for non_silent_seg in non_silent_segs:
-                if len(non_silent_wave) > 6000 and len(non_silent_wave + non_silent_seg) > 15000:
-                    logging.info("Audio is over 15s, clipping short. (1)")
-                    break
-                non_silent_wave += non_silent_seg
-
-            # 2. try to find short silence for clipping if 1. failed
-            if len(non_silent_wave) > 15000:
-                non_silent_segs = silence.split_on_silence(
-                    aseg, min_silence_len=100, silence_thresh=-40, keep_silence=1000, seek_step=10
-                )
-                non_silent_wave = AudioSegment.silent(duration=0)
-                for non_silent_seg in non_silent_segs:
-                    if len(non_silent_wave) > 6000 and len(non_silent_wave + non_silent_seg) > 15000:
-                        logging.info("Audio is over 15s, clipping short. (2)")
-                        break
-                    non_silent_wave += non_silent_seg
-
-            aseg = non_silent_wave
-
-            # 3. if no proper silence found for clipping
-            if len(aseg) > 15000:
-                aseg = aseg[:15000]
-                logging.info("Audio is over 15s, clipping short. (3)")
-
-            aseg = remove_silence_edges(aseg) + AudioSegment.silent(duration=50)
-            aseg.export(temp_short_ref, format='wav')
-            
-            # Transcribe the short clip
-            ref_text = model.transcribe(temp_short_ref)
-            logging.info(f'Reference text transcribed from first 14s: {ref_text}')
-            
-            # Use the short clip as reference
-            reference_file = temp_short_ref
-        
-        save_path = f'{output_dir}/output_synthesized.wav'
-        
-        # Use the model's built-in text chunking and processing
-        wav, sr, _ = model.infer(
-            ref_file=reference_file,
-            ref_text=ref_text,
-            gen_text=text,
-            speed=speed,
-            nfe_step=32,
-            cfg_strength=2.0,
-            file_wave=save_path
-        )
+        ref = await asyncio.to_thread(get_reference, reference_file, default_ref_text if voice == "default_en" else "")
 
-        #result = StreamingResponse(open(save_path, 'rb'), media_type="audio/wav")
-
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-
-        """
-        result.headers["X-Elapsed-Time"] = str(elapsed_time)
-        result.headers["X-Device-Used"] = device
+        jobs = await asyncio.to_thread(
+            plan_speech_jobs, ref, text, speed=speed, nfe_step=32, cfg_strength=2.0, use_smooth_cache=cache == "smooth"
+        )
 
-        # Add CORS headers
-        result.headers["Access-Control-Allow-Origin"] = "*"
-        result.headers["Access-Control-Allow-Credentials"] = "true"
-        result.headers["Access-Control-Allow-Headers"] = "Origin, Content-Type, X-Amz-Date, Authorization, X-Api-Key, X-Amz-Security-Token, locale"
-        result.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
-        """
         # Prepare headers
         headers = {
-            "X-Elapsed-Time": str(elapsed_time),
             "X-Device-Used": device,
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Credentials": "true",
             "Access-Control-Allow-Headers": "Origin, Content-Type, X-Amz-Date, Authorization, X-Api-Key, X-Amz-Security-Token, locale",
             "Access-Control-Allow-Methods": "POST, OPTIONS",
         }
-        return FileResponse(
-            path=save_path,
-            media_type="audio/wav",
-            filename="output_synthesized.wav",
-            headers=headers,  # ✅ Attach headers
-        )
-        
-        #return result
+        return StreamingResponse(stream_speech(jobs), media_type="audio/wav", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))